@@ -10,10 +10,6 @@ import sys, os
 parent_dir = os.path.abspath(os.path.join(os.getcwd(), ".."))
 sys.path.append(parent_dir)
 
-print(parent_dir)
-
-from app.core.config import settings
-from app.db.core import metadata
 from alembic import context
 
 # this is the Alembic config object which provides access to the values in the .ini file
@@ -22,12 +18,23 @@ config = context.config
 # interpret the config file for logging purposes
 fileConfig(config.config_file_name)
 
-# note how it's 'raw' metadata not the one attached to Base as there is no Base
-target_metadata = metadata
-URL = settings.db_url
+
+def _load_app_settings():
+    '''
+    app settings and 'raw' metadata (not the one attached to Base as there is no Base) are only imported when migrations
+    actually run, so parsing this module does not pull in the app's db layer
+    :return URL (str): db url
+    :return target_metadata (sqlalchemy MetaData)
+    '''
+
+    from app.core.config import settings
+    from app.db.core import metadata
+
+    return settings.db_url, metadata
 
 
 def run_migrations_offline():
+    URL, target_metadata = _load_app_settings()
 
     context.configure(
         url=URL,
@@ -42,17 +49,22 @@ def run_migrations_offline():
 
 
 def run_migrations_online():
-    connectable = create_engine(URL)
-
-    with connectable.connect() as connection:
-        context.configure(
-            connection=connection,
-            target_metadata=target_metadata,
-            user_module_prefix='sa.'
-        )
-
-    with context.begin_transaction():
-        context.run_migrations()
+    URL, target_metadata = _load_app_settings()
+    connectable = create_engine(URL, pool_size=1, max_overflow=0, pool_pre_ping=True)
+
+    # all migrations run on one connection, which must still be open while they run
+    try:
+        with connectable.connect() as connection:
+            context.configure(
+                connection=connection,
+                target_metadata=target_metadata,
+                user_module_prefix='sa.'
+            )
+
+            with context.begin_transaction():
+                context.run_migrations()
+    finally:
+        connectable.dispose()
 
 
 if context.is_offline_mode():
@@ -0,0 +1,90 @@
+"""move model objects to own table
+
+Moves the serialized model objects from the column 'experiments.model_object_binary' to the table
+'experiment_model_objects', re-encoding them from the former dill pickles to the format of
+ParseModel.dump_model_object_binary_to_string
+
+Revision ID: 8d3c5e1f2a47
+Revises:
+Create Date: 2026-10-15 12:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '8d3c5e1f2a47'
+down_revision = None
+branch_labels = None
+depends_on = None
+
+
+def _tables():
+    '''
+    lightweight table definitions for the data migration, independent of the current ormar models
+    :return experiments (sqlalchemy Table)
+    :return model_objects (sqlalchemy Table)
+    '''
+
+    metadata = sa.MetaData()
+    experiments = sa.Table("experiments", metadata, sa.Column("id", sa.Integer, primary_key=True),
+                           sa.Column("model_object_binary", sa.LargeBinary))
+    model_objects = sa.Table("experiment_model_objects", metadata, sa.Column("id", sa.Integer, primary_key=True),
+                             sa.Column("experiment", sa.Integer), sa.Column("model_object_binary", sa.LargeBinary))
+    return experiments, model_objects
+
+
+def upgrade():
+    # imported here, these pull in the modeling backend and are only needed to re-encode the model objects
+    import dill
+    from app.experimentops.utils import ParseModel
+
+    bind = op.get_bind()
+    inspector = sa.inspect(bind)
+
+    # the table may already exist if the app created missing tables at startup (settings.create_schema)
+    if "experiment_model_objects" not in inspector.get_table_names():
+        op.create_table(
+            "experiment_model_objects",
+            sa.Column("id", sa.Integer, primary_key=True, autoincrement=True),
+            sa.Column("experiment", sa.Integer, sa.ForeignKey("experiments.id"), nullable=False, unique=True),
+            sa.Column("model_object_binary", sa.LargeBinary(length=1000000), nullable=False),
+        )
+
+    if "model_object_binary" not in {c["name"] for c in inspector.get_columns("experiments")}:
+        return
+
+    experiments, model_objects = _tables()
+    migrated = set(bind.execute(sa.select([model_objects.c.experiment])).scalars())
+
+    # one experiment at a time, model objects can be large
+    exp_ids = bind.execute(sa.select([experiments.c.id]).where(experiments.c.model_object_binary.isnot(None))) \
+        .scalars().all()
+    for exp_id in exp_ids:
+        if exp_id in migrated:
+            continue
+        old_binary = bind.execute(sa.select([experiments.c.model_object_binary])
+                                  .where(experiments.c.id == exp_id)).scalar()
+        mdl_binary = ParseModel.dump_model_object_binary_to_string(dill.loads(old_binary))
+        bind.execute(model_objects.insert().values(experiment=exp_id, model_object_binary=mdl_binary))
+
+    op.drop_column("experiments", "model_object_binary")
+
+
+def downgrade():
+    import dill
+    from app.experimentops.utils import ParseModel
+
+    bind = op.get_bind()
+    op.add_column("experiments", sa.Column("model_object_binary", sa.LargeBinary(length=1000000), nullable=True))
+
+    experiments, model_objects = _tables()
+    rows = bind.execute(sa.select([model_objects.c.id, model_objects.c.experiment])).all()
+    for row_id, exp_id in rows:
+        mdl_binary = bind.execute(sa.select([model_objects.c.model_object_binary])
+                                  .where(model_objects.c.id == row_id)).scalar()
+        old_binary = dill.dumps(ParseModel.load_model_object_binary_from_string(mdl_binary))
+        bind.execute(experiments.update().where(experiments.c.id == exp_id).values(model_object_binary=old_binary))
+
+    op.drop_table("experiment_model_objects")
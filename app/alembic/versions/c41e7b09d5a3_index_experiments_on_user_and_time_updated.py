@@ -0,0 +1,40 @@
+"""index experiments on user and time_updated
+
+Replaces the index on 'experiments.time_updated' by a composite index on ('user', 'time_updated'), which serves lookups
+of experiments by user as well as listing them ordered by time_updated
+
+Revision ID: c41e7b09d5a3
+Revises: 8d3c5e1f2a47
+Create Date: 2026-10-15 12:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c41e7b09d5a3'
+down_revision = '8d3c5e1f2a47'
+branch_labels = None
+depends_on = None
+
+
+def _index_names():
+    return {index["name"] for index in sa.inspect(op.get_bind()).get_indexes("experiments")}
+
+
+def upgrade():
+    # indexes may already exist if the app created missing tables at startup (settings.create_schema)
+    indexes = _index_names()
+    if "ix_experiments_user_time_updated" not in indexes:
+        op.create_index("ix_experiments_user_time_updated", "experiments", ["user", "time_updated"])
+    if "ix_experiments_time_updated" in indexes:
+        op.drop_index("ix_experiments_time_updated", table_name="experiments")
+
+
+def downgrade():
+    indexes = _index_names()
+    if "ix_experiments_time_updated" not in indexes:
+        op.create_index("ix_experiments_time_updated", "experiments", ["time_updated"])
+    if "ix_experiments_user_time_updated" in indexes:
+        op.drop_index("ix_experiments_user_time_updated", table_name="experiments")
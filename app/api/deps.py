@@ -1,15 +1,19 @@
-from typing import Optional
-from pydantic import BaseModel, ValidationError
-from fastapi import Depends, HTTPException, status
-from fastapi.security import HTTPBasic
-from jose import jwt, JWTError
+import ormar
+from cachetools import TTLCache
+from fastapi import Depends, HTTPException, Security, status
+from fastapi.security import HTTPAuthorizationCredentials
+from jose import jwt, JWTError, ExpiredSignatureError
 
-from app.core.auth import oauth2_scheme
+from app.core.auth import oauth2_scheme, bearer_scheme, JWT_KEY, JWT_ALGORITHMS
+from app.core.auth_cache import decode_cached
 from app.core.config import settings
 from app.db import User, TokenData
 
 
-bearer_security = HTTPBasic()  #scheme_name="Authorization"
+# fields of the users of validated tokens by user id. Rows in 'users' rarely change within the lifetime of a token, so
+# users are kept as long as validated tokens (settings.AUTH_CACHE_SECONDS) before being looked up in the db again. Only
+# the field values are cached, each request gets its own User instance as instances get modified when used in relations
+_user_cache = TTLCache(maxsize=5000, ttl=settings.AUTH_CACHE_SECONDS)
 
 
 async def get_current_user(token: str = Depends(oauth2_scheme)) -> User:
@@ -25,8 +29,8 @@ async def get_current_user(token: str = Depends(oauth2_scheme)) -> User:
     try:
         payload = jwt.decode(
             token,
-            settings.JWT_SECRET,
-            algorithms=[settings.ALGORITHM],
+            JWT_KEY,
+            algorithms=JWT_ALGORITHMS,
             options={"verify_aud": False},
         )
         username: str = payload.get("sub")
@@ -42,32 +46,66 @@ async def get_current_user(token: str = Depends(oauth2_scheme)) -> User:
     return user
 
 
-async def validate_token(http_authorization_credentials=Depends(bearer_security)):
-    """
-    get the JWT and decode the token for username and password
+def decode_access_token(token: str) -> dict:
     """
+    decode and verify an access token (via the cache of verified payloads). Tokens missing the 'exp' or 'sub' claims
+    are rejected by the decoder, so no work is spent on them beyond the signature check
 
-    print(http_authorization_credentials)
+    :param token (str): JWT
+    :return payload (dict): claims of the token
+    """
 
     try:
-        # decode
-        payload = jwt.decode(http_authorization_credentials.credentials, settings.JWT_SECRET,
-                             algorithm=settings.ALGORITHM)
+        payload = decode_cached(token)
+    except ExpiredSignatureError:
+        raise HTTPException(status_code=403, detail="Token expired")
+    except JWTError:
+        raise HTTPException(status_code=403, detail="Could not validate credentials")
+
+    if not payload.get("type") == "access_token" or not payload["sub"].isdigit():
+        raise HTTPException(status_code=401, detail="Invalid token")
+
+    return payload
+
+
+async def current_user(credentials: HTTPAuthorizationCredentials = Security(bearer_scheme)) -> User:
+    """
+    get the user for the JWT provided as bearer token. Both the verified token payload and the user are served from
+    in-process caches when available, so repeated requests with the same token usually skip decoding of the JWT as well
+    as the lookup of the user in the db
+
+    :param credentials: HTTPAuthorizationCredentials object, contains token in attribute 'credentials'
+    """
 
-        # check user
-        user_db = await User.objects.filter(id=int(payload.get("sub"))).first()
-        if not user_db:
+    # decode and check user
+    payload = decode_access_token(credentials.credentials)
+    user_id = int(payload["sub"])
+
+    user_fields = _user_cache.get(user_id)
+    if user_fields is None:
+        user = await User.objects.filter(id=user_id).first()
+        if not user:
             raise HTTPException(status_code=401, detail="Invalid token")
-        if not payload.get("exp") < datetime.utcnow():
-            raise HTTPException(status_code=403, detail="Token expired")
+        _user_cache[user_id] = user.dict(exclude=User.extract_related_names())
+        return user
 
-        return {
-            "username": user.email,
-            "uuid": user.uuid,
-            "access_token": create_access_token(sub=user.id),
-            "token_type": "bearer",
-        }
+    return User.construct(**user_fields)
 
-    except (JWTError, ValidationError):
-        raise HTTPException(status_code=403, detail="Could not validate credentials")
 
+def forget_user(user_id: int):
+    """
+    remove user from the cache of authenticated users, to be called whenever a user is changed or deleted
+    """
+
+    _user_cache.pop(user_id, None)
+
+
+@ormar.post_update(User)
+@ormar.post_delete(User)
+async def _forget_changed_user(sender, instance: User, **kwargs):
+    """
+    drop users from the cache when they are updated or deleted via their model instance in this process. Bulk updates
+    on the queryset do not send signals, users changed that way are looked up again after settings.AUTH_CACHE_SECONDS
+    """
+
+    forget_user(instance.id)
@@ -2,6 +2,8 @@ from fastapi import APIRouter
 from app.api.routes.user import router as user_router
 from app.api.routes.auth import router as auth_router
 from app.api.routes.experiment import router as exp_router
+from app.api.routes.debug import router as debug_router
+from app.core.config import settings
 
 
 router = APIRouter()
@@ -10,3 +12,7 @@ router = APIRouter()
 router.include_router(user_router, prefix="/user", tags=["User"])
 router.include_router(auth_router, prefix="/auth", tags=["Authentication and authorization"])
 router.include_router(exp_router, prefix="/experiment", tags=["Experiment"])
+
+# debug endpoints are only available when enabled in settings
+if settings.debug_endpoints:
+    router.include_router(debug_router, prefix="/debug", tags=["Debug"])
@@ -1,16 +1,10 @@
-from datetime import datetime
-from fastapi import APIRouter, HTTPException, Depends, Request, Security
-from jose import JWTError, jwt, ExpiredSignatureError
-from pydantic import ValidationError
-from starlette.status import HTTP_201_CREATED, HTTP_400_BAD_REQUEST
-from fastapi.security import OAuth2PasswordRequestForm, HTTPBasicCredentials, HTTPAuthorizationCredentials
-from app.db import User, PublicUser, CreateUser, Token, TokenData
-from app.core.auth import authenticate, create_access_token, bearer_scheme, refresh_token, get_user_by_email
-from app.core.config import settings
-from app.core.security import get_password_hash
+from fastapi import APIRouter, HTTPException, Depends
+from starlette.status import HTTP_201_CREATED
+from fastapi.security import OAuth2PasswordRequestForm
+from app.db import User, PublicUser, Token
+from app.core.auth import authenticate, create_access_token
 from app.api import deps
 
-
 router = APIRouter()
 
 
@@ -52,37 +46,16 @@ async def login_for_access_token(form_data: OAuth2PasswordRequestForm = Depends(
 
 
 @router.post("/header-me")
-async def confirm_user_header_me(credentials: HTTPAuthorizationCredentials = Security(bearer_scheme)):
+async def confirm_user_header_me(user: User = Depends(deps.current_user)):
     """
-    get the JWT and decode the token for username and password
+    get the user for the JWT provided as bearer token and issue a fresh access token
 
-    :param credentials: HTTPAuthorizationCredentials object, contains token in attribute 'credentials'
+    :param user (User): authenticated user, resolved from the bearer token
     """
 
-    try:
-        # decode
-        payload = jwt.decode(credentials.credentials, settings.JWT_SECRET, algorithms=[settings.ALGORITHM])
-
-        # check user
-        user = await User.objects.filter(id=int(payload.get("sub"))).first()
-        #user = await get_user_by_email(email=payload.get("sub"))
-        if not payload["type"] == "access_token":
-            raise HTTPException(status_code=401, detail="Invalid token")
-        if not user:
-            raise HTTPException(status_code=401, detail="Invalid token")
-
-        return {
-            "username": user.email,
-            "uuid": user.uuid,
-            "access_token": create_access_token(sub=user.id),
-            "token_type": "bearer",
-        }
-
-    except (JWTError, ValidationError):
-        raise HTTPException(status_code=403, detail="Could not validate credentials")
-    except ExpiredSignatureError:
-        raise HTTPException(status_code=403, detail="Token expired")
-
-
-
-
+    return {
+        "username": user.email,
+        "uuid": user.uuid,
+        "access_token": create_access_token(sub=user.id),
+        "token_type": "bearer",
+    }
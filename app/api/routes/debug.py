@@ -0,0 +1,18 @@
+from fastapi import APIRouter, Depends
+from starlette.status import HTTP_200_OK
+
+from app.api import deps
+from app.db import pool_stats
+
+
+# debug endpoints require a valid JWT (token)
+router = APIRouter(dependencies=[Depends(deps.current_user)])
+
+
+@router.get("/pool", status_code=HTTP_200_OK)
+async def pool():
+    '''
+    state of the connection pool to the db
+    '''
+
+    return pool_stats()
@@ -1,24 +1,32 @@
-from fastapi import APIRouter, Security, HTTPException, Body
-from starlette.status import HTTP_201_CREATED, HTTP_200_OK, HTTP_202_ACCEPTED
-from jose import JWTError, jwt, ExpiredSignatureError
-from fastapi.security import HTTPAuthorizationCredentials
-from pydantic import ValidationError, Json
+from fastapi import APIRouter, Depends, HTTPException, Body
+from fastapi.responses import ORJSONResponse
+from pydantic import ValidationError
+from starlette.status import HTTP_201_CREATED, HTTP_200_OK, HTTP_202_ACCEPTED, HTTP_422_UNPROCESSABLE_ENTITY
+from starlette.concurrency import run_in_threadpool
 from uuid import UUID
-from typing import List
+
+import orjson
 
 from app.db import PublicCreateExperiment, PublicExperiment, User, Experiment, PublicExperimentAsk, \
-    PublicExperimentBase, PublicExperimentTell
-from app.core.auth import bearer_scheme
-from app.core.config import settings
+    PublicExperimentTell, TellData
+from app.api import deps
 from app.experimentops.actions import ExperimentOperations
 
 router = APIRouter()
 
+# fields returned for each experiment when listing experiments
+EXPERIMENT_LIST_FIELDS = ["exp_uuid", "name", "description", "covars", "model_type", "acq_func_type", "time_created",
+                          "time_updated", "active", "best_response", "covars_best_response", "covars_sampled_iter",
+                          "response_sampled_iter"]
+
+# JSON columns among EXPERIMENT_LIST_FIELDS. Rows from QuerySet.values hold these as the raw JSON strings from the db
+EXPERIMENT_LIST_JSON_FIELDS = ["covars", "best_response", "covars_best_response"]
+
 
 @router.post("/new", response_model=PublicExperiment, status_code=HTTP_201_CREATED)
 async def create_new_experiment(
         new_exp: PublicCreateExperiment,
-        credentials: HTTPAuthorizationCredentials = Security(bearer_scheme)
+        user: User = Depends(deps.current_user)
 ):
     '''
     secured API endpoint to create new experiment. User must provide valid JWT (token) to set up new experiment via
@@ -27,109 +35,72 @@ async def create_new_experiment(
     using PublicExperiment data model to provide exp details
     '''
 
+    # parse the provided experiment and cast for Experiment class in db. Initializes the TuneSession model object,
+    # which is CPU-bound, so this runs in the threadpool. Invalid experiments are reported as unprocessable entity
     try:
-        # decode
-        payload = jwt.decode(credentials.credentials, settings.JWT_SECRET, algorithms=[settings.ALGORITHM])
-
-        # check user
-        user = await User.objects.filter(id=int(payload.get("sub"))).first()
-        # user = await get_user_by_email(email=payload.get("sub"))
-        if not payload["type"] == "access_token":
-            raise HTTPException(status_code=401, detail="Invalid token")
-        if not user:
-            raise HTTPException(status_code=401, detail="Invalid token")
+        exp, mdl_binary = await run_in_threadpool(ExperimentOperations.parse_new_experiment, new_exp=new_exp, user=user)
+    except ValidationError as e:
+        raise HTTPException(status_code=HTTP_422_UNPROCESSABLE_ENTITY, detail=e.errors())
 
-        # parse the provided experiment and cast for Experiment class in db
-        exp = ExperimentOperations.parse_new_experiment(new_exp=new_exp, user=user)
+    await ExperimentOperations.save_new_experiment(exp=exp, mdl_binary=mdl_binary)
 
-        await exp.save()
+    # retrieve stored result to return
+    new_exp_public = await ExperimentOperations.public_experiment(exp_uuid=exp.exp_uuid)
 
-        # retrieve stored result to return
-        new_exp_public = await ExperimentOperations.public_experiment(exp_uuid=exp.exp_uuid)
-
-        return new_exp_public
-
-    except (JWTError, ValidationError):
-        raise HTTPException(status_code=403, detail="Could not validate credentials")
-    except ExpiredSignatureError:
-        raise HTTPException(status_code=403, detail="Token expired")
+    return new_exp_public
 
 
 @router.get("/ask/{exp_uuid}", response_model=PublicExperimentAsk, status_code=HTTP_200_OK)
-async def experiment_ask(exp_uuid: UUID, credentials: HTTPAuthorizationCredentials = Security(bearer_scheme)):
+async def experiment_ask(exp_uuid: UUID, user: User = Depends(deps.current_user)):
     '''
     endpoint to retrieve the covariates for which the algorithm believes the response will generate the most new
     knowledge wrt finding the optimum
     :param exp_uuid (UUID): unique identifier for experiment
-    :param credentials:
+    :param user (User): authenticated user, resolved from the bearer token
     :return:
     '''
 
-    try:
-        # decode
-        payload = jwt.decode(credentials.credentials, settings.JWT_SECRET, algorithms=[settings.ALGORITHM])
-
-        # check user
-        user = await User.objects.filter(id=int(payload.get("sub"))).first()
-        if not payload["type"] == "access_token":
-            raise HTTPException(status_code=401, detail="Invalid token")
-        if not user:
-            raise HTTPException(status_code=401, detail="Invalid token")
+    # get experiment, restricted to experiments of this user so access is checked in the same query. Experiments of
+    # other users are reported as not found
+    exp = await Experiment.objects.filter(exp_uuid=exp_uuid, user=user.id).first()
+    if not exp:
+        raise HTTPException(status_code=404, detail="Experiment not found")
 
-        # check user has access to experiment
-        exp = await Experiment.objects.filter(exp_uuid=exp_uuid).first()
-        await exp.user.load()  # load the user for this exp from the db
-        if not exp:
-            raise HTTPException(status_code=404, detail="Experiment not found")
-        if not exp.user.uuid == user.uuid:
-            raise HTTPException(status_code=403, detail="Forbidden. User does not have access to this experiment")
+    # determine covars for next experiment via TuneSession's ask-method, update experiment and return
+    next_covars = await ExperimentOperations.ask_next_datapoint(exp)
 
-        # determine covars for next experiment via TuneSession's ask-method, update experiment and return
-        next_covars = await ExperimentOperations.ask_next_datapoint(exp)
+    return next_covars
 
-        return next_covars
 
-    except (JWTError, ValidationError):
-        raise HTTPException(status_code=403, detail="Could not validate credentials")
-    except ExpiredSignatureError:
-        raise HTTPException(status_code=403, detail="Token expired")
-
-
-@router.get("/all", response_model=List[PublicExperimentBase], response_model_exclude={"user_uuid"}, status_code=HTTP_200_OK)
-async def experiment_all(credentials: HTTPAuthorizationCredentials = Security(bearer_scheme)):
+@router.get("/all", response_class=ORJSONResponse, status_code=HTTP_200_OK)
+async def experiment_all(user: User = Depends(deps.current_user)):
     '''
-    endpoint to post all experiments by user with provided credentials, ordered by last update date
+    endpoint to post all experiments by user with provided credentials, ordered by last update date. Rows are returned
+    as plain dicts of the columns in EXPERIMENT_LIST_FIELDS, without instantiating Experiment objects
     '''
 
-    try:
-        # decode
-        payload = jwt.decode(credentials.credentials, settings.JWT_SECRET, algorithms=[settings.ALGORITHM])
-
-        # check user
-        user = await User.objects.filter(id=int(payload.get("sub"))).first()
-        if not payload["type"] == "access_token":
-            raise HTTPException(status_code=401, detail="Invalid token")
-        if not user:
-            raise HTTPException(status_code=401, detail="Invalid token")
+    # find all experiments where user is JWT user and sort based on time_updated
+    experiments = await Experiment.objects.filter(user=user.id).order_by(Experiment.time_updated.desc()) \
+        .values(EXPERIMENT_LIST_FIELDS)
 
-        # find all experiments where user is JWT user and sort based on time_updated
-        experiments = await Experiment.objects.filter(user__uuid=user.uuid).order_by(Experiment.time_updated.desc()).all()
+    # return rows in the format of PublicExperimentBase: JSON columns parsed, and the acquisition function as
+    # 'acq_func'
+    for row in experiments:
+        for field in EXPERIMENT_LIST_JSON_FIELDS:
+            if isinstance(row[field], (str, bytes)):
+                row[field] = orjson.loads(row[field])
+        row["acq_func"] = row.pop("acq_func_type")
 
-        return experiments
-
-    except (JWTError, ValidationError):
-        raise HTTPException(status_code=403, detail="Could not validate credentials")
-    except ExpiredSignatureError:
-        raise HTTPException(status_code=403, detail="Token expired")
+    return ORJSONResponse(experiments)
 
 
 # ednpoint to report results
 @router.post("/tell/{exp_uuid}", response_model=PublicExperimentTell, status_code=HTTP_202_ACCEPTED)
 async def experiment_tell(
         exp_uuid: UUID,
-        covars_tell: Json = Body(...),
-        response_tell: Json = Body(...),
-        credentials: HTTPAuthorizationCredentials = Security(bearer_scheme)
+        covars_tell: TellData = Body(...),
+        response_tell: TellData = Body(...),
+        user: User = Depends(deps.current_user)
 ):
     '''
     endpoint for reporting the results of the last experiment (outcome with the last set of covariates obtained from
@@ -139,33 +110,15 @@ async def experiment_tell(
     to match the proposed covariates from /ask/{exp_uuid}
     '''
 
-    try:
-        # decode
-        payload = jwt.decode(credentials.credentials, settings.JWT_SECRET, algorithms=[settings.ALGORITHM])
-
-        # check user
-        user = await User.objects.filter(id=int(payload.get("sub"))).first()
-        if not payload["type"] == "access_token":
-            raise HTTPException(status_code=401, detail="Invalid token")
-        if not user:
-            raise HTTPException(status_code=401, detail="Invalid token")
-
-        # check user has access to experiment
-        exp = await Experiment.objects.filter(exp_uuid=exp_uuid).first()
-        await exp.user.load()  # load the user for this exp from the db
-        if not exp:
-            raise HTTPException(status_code=404, detail="Experiment not found")
-        if not exp.user.uuid == user.uuid:
-            raise HTTPException(status_code=403, detail="Forbidden. User does not have access to this experiment")
-
-        # send exp, covars_tell and response_tell to backend method for processing
-        tell_exp = await ExperimentOperations.tell_datapoint(exp=exp,
-                                                             covars_tell=covars_tell,
-                                                             response_tell=response_tell)
-
-        return tell_exp
-
-    except (JWTError, ValidationError):
-        raise HTTPException(status_code=403, detail="Could not validate credentials")
-    except ExpiredSignatureError:
-        raise HTTPException(status_code=403, detail="Token expired")
\ No newline at end of file
+    # get experiment, restricted to experiments of this user so access is checked in the same query. Experiments of
+    # other users are reported as not found
+    exp = await Experiment.objects.filter(exp_uuid=exp_uuid, user=user.id).first()
+    if not exp:
+        raise HTTPException(status_code=404, detail="Experiment not found")
+
+    # send exp, covars_tell and response_tell to backend method for processing
+    tell_exp = await ExperimentOperations.tell_datapoint(exp=exp,
+                                                         covars_tell=covars_tell,
+                                                         response_tell=response_tell)
+
+    return tell_exp
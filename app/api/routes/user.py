@@ -1,7 +1,8 @@
-from fastapi import APIRouter
+from fastapi import APIRouter, HTTPException
+from fastapi.concurrency import run_in_threadpool
 from typing import List
 from uuid import UUID
-from starlette.status import HTTP_201_CREATED
+from starlette.status import HTTP_201_CREATED, HTTP_400_BAD_REQUEST
 from app.core.security import get_password_hash
 from app.db import User, CreateUser, PublicUser
 
@@ -11,7 +12,8 @@ router = APIRouter()
 
 @router.get("/", response_model=List[PublicUser])
 async def get_users():
-    users = await User.objects.select_related("item").all()
+    # 'users' has no relations that are part of PublicUser, so a plain select of the table suffices
+    users = await User.objects.all()
     return users
 
 @router.get("/{user_id}", response_model=User, response_model_exclude={"hashed_password"})
@@ -37,7 +39,8 @@ async def create_user_signup(user_in: CreateUser):
     # create user if the email address is new
     obj_in = user_in.dict()
     obj_in.pop("password")
-    obj_in["hashed_password"] = get_password_hash(user_in.password)
+    obj_in["hashed_password"] = await run_in_threadpool(get_password_hash, user_in.password)  # CPU-bound
     db_obj = User(**obj_in)
+    db_obj = await db_obj.save()
 
-    return await db_obj.save()
\ No newline at end of file
+    return db_obj
\ No newline at end of file
@@ -1,8 +1,9 @@
 from typing import Optional, MutableMapping, List, Union
 from datetime import datetime, timedelta
 
+from fastapi.concurrency import run_in_threadpool
 from fastapi.security import OAuth2PasswordBearer, HTTPBearer
-from jose import jwt
+from jose import jwk, jwt
 
 from app.db import User
 from app.core.config import settings
@@ -15,6 +16,12 @@ oauth2_scheme = OAuth2PasswordBearer(tokenUrl="/auth/login")
 
 bearer_scheme = HTTPBearer()
 
+# JWT signing and decoding parameters, resolved once rather than on every request. The key object is passed to jose
+# directly, so the secret is not parsed into a key again for every token which is created or decoded
+JWT_KEY = jwk.construct(settings.JWT_SECRET, settings.ALGORITHM)
+JWT_ALGORITHMS = [settings.ALGORITHM]
+JWT_DECODE_OPTIONS = {"require_exp": True, "require_sub": True}
+
 
 async def get_user_by_email(email: str) -> Optional[User]:
     return await User.objects.filter(email=email).first()  # User.objects.get_or_none(email=email)
@@ -29,7 +36,7 @@ async def authenticate(email: str, password: str) -> Optional[User]:
 
     if not user:
         return None
-    if not verify_password(password, user.hashed_password):
+    if not await run_in_threadpool(verify_password, password, user.hashed_password):  # CPU-bound
         return None
     return user
 
@@ -65,7 +72,7 @@ def _create_token(token_type: str, lifetime: timedelta, sub: str) -> str:
     # subject of the JWT
     payload["sub"] = str(sub)
 
-    return jwt.encode(payload, settings.JWT_SECRET, algorithm=settings.ALGORITHM)
+    return jwt.encode(payload, JWT_KEY, algorithm=settings.ALGORITHM)
 
 
 def create_refresh_token(*, sub: str) -> str:
@@ -77,6 +84,6 @@ def create_refresh_token(*, sub: str) -> str:
 
 
 def refresh_token(*, refresh_token) -> str:
-    payload = jwt.decode(refresh_token, settings.JWT_SECRET, algorithms=[settings.ALGORITHM])
+    payload = jwt.decode(refresh_token, JWT_KEY, algorithms=JWT_ALGORITHMS)
     if (payload["type"] == "refresh_token"):
         sub = payload["sub"]
@@ -0,0 +1,35 @@
+"""
+in-process cache of verified JWT payloads
+"""
+import hashlib
+import time
+from cachetools import TTLCache
+from jose import jwt
+
+from app.core.auth import JWT_KEY, JWT_ALGORITHMS, JWT_DECODE_OPTIONS
+from app.core.config import settings
+
+
+# verified payloads keyed by the sha256 digest of the token. Only tokens which decode successfully are stored
+_payload_cache = TTLCache(maxsize=10000, ttl=settings.AUTH_CACHE_SECONDS)
+
+
+def decode_cached(token: str) -> dict:
+    """
+    decode and verify JWT, serving payloads of tokens which have been verified already from cache. On a cache hit only
+    the expiry of the token is checked. Raises the same exceptions as jose.jwt.decode on a cache miss
+
+    :param token (str): JWT
+    :return payload (dict): claims of the token
+    """
+
+    key = hashlib.sha256(token.encode()).digest()
+
+    payload = _payload_cache.get(key)
+    if payload is not None and payload["exp"] > time.time():
+        return payload
+
+    payload = jwt.decode(token, JWT_KEY, algorithms=JWT_ALGORITHMS, options=JWT_DECODE_OPTIONS)
+    _payload_cache[key] = payload
+
+    return payload
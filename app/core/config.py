@@ -42,6 +42,11 @@ class Settings(BaseSettings):
   db_server: str = Field(..., env="POSTGRES_SERVER")
   db_port: str = Field(..., env="POSTGRES_PORT")
   db_db: str = Field(..., env="POSTGRES_DB")
+  db_pool_min_size: int = Field(5, env="DB_POOL_MIN_SIZE")  # connection pool used for requests
+  db_pool_max_size: int = Field(20, env="DB_POOL_MAX_SIZE")
+  create_schema: bool = Field(True, env="CREATE_SCHEMA")  # create missing tables at startup, disable to use alembic only
+  warm_up_model: bool = Field(True, env="WARM_UP_MODEL")  # build a throwaway model at startup, disable for faster start
+  debug_endpoints: bool = Field(False, env="DEBUG_ENDPOINTS")  # mount the /debug endpoints (pool state, for authenticated users)
   project_name: str = Field(..., env="PROJECT_NAME")
   project_version: str = Field(..., env="PROJECT_VERSION")
 
@@ -49,6 +54,7 @@ class Settings(BaseSettings):
   JWT_SECRET: str = "TEST_SECRET_DO_NOT_USE_IN_PROD"
   ALGORITHM: str = "HS256"
   ACCESS_TOKEN_EXPIRE_MINUTES: int = 60*24*8  # 60 minutes * 24 hours * 8 days
+  AUTH_CACHE_SECONDS: int = 300  # how long a validated token (and its user) is served from the in-process cache
 
   class Config:
     env_file = os.path.join(os.path.join(basepath, os.pardir), '.env')
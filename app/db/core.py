@@ -5,10 +5,32 @@ import sqlalchemy
 from app.core.config import settings
 
 
-database = databases.Database(settings.db_url)
+database = databases.Database(settings.db_url, min_size=settings.db_pool_min_size, max_size=settings.db_pool_max_size)
 metadata = sqlalchemy.MetaData()
 
 
 class BaseMeta(ormar.ModelMeta):
     metadata = metadata
     database = database
+
+
+def pool_stats():
+    '''
+    state of the connection pool to the db. The current size and number of idle connections are only reported while
+    connected, as the pool of the postgres backend (asyncpg) is created when the app connects at startup
+    :return pool_state (dict)
+    '''
+
+    pool_state = {
+        "connected": database.is_connected,
+        "min_size": settings.db_pool_min_size,
+        "max_size": settings.db_pool_max_size,
+    }
+
+    # 'databases' does not expose its pool, the asyncpg pool is held by the postgres backend
+    pool = getattr(database._backend, "_pool", None)
+    if pool is not None:
+        pool_state["size"] = pool.get_size()
+        pool_state["idle"] = pool.get_idle_size()
+
+    return pool_state
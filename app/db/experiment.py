@@ -2,10 +2,12 @@ from datetime import datetime
 import ormar
 import pydantic
 from enum import Enum
-from pydantic import Json, validator, root_validator, StrictInt, StrictFloat, StrictStr, UUID4
-from typing import Set, Dict, Union, Optional
+from sqlalchemy import func
+from pydantic import Json, root_validator, StrictInt, StrictFloat, StrictStr, UUID4
+from typing import Any, Set, Dict, List, Union, Optional
 import uuid
-from greattunes import TuneSession
+from greattunes._acq_func import AcqFunction
+from greattunes._modeling import _models_list
 
 from app.db.core import BaseMeta
 from app.db.user import User
@@ -17,6 +19,10 @@ class VarType(Enum):
     cat = "cat"
 
 
+# python data type of each variable type, and the name of that data type as used for 'type' in covars of TuneSession
+_VTYPE_MAP = {VarType.int: (int, "int"), VarType.cont: (float, "float"), VarType.cat: (str, "str")}
+
+
 class Variable(pydantic.BaseModel):
     vtype: VarType
     guess: Union[StrictFloat, StrictInt, StrictStr]
@@ -24,77 +30,37 @@ class Variable(pydantic.BaseModel):
     max: Optional[Union[StrictFloat, StrictInt]] = None
     options: Optional[Set[str]] = None
 
-    # this check is needed to make 'type' available for 'check_guess' validator, but it is not otherwise needed since
-    # VarType itself ensures type validation
-    @validator('vtype', allow_reuse=True)
-    def req_check(cls, t):
-        assert t.value in ['int', 'cont', 'cat'], "'vtype' must take value from set ['int', 'cont', 'cat']"
-        return t
-
-    # add new field called "type"
-    @root_validator(pre=False, allow_reuse=True)
-    def insert_type(cls, values):
-        if values['vtype'].value == 'int':
-            values['type'] = 'int'
-        elif values['vtype'].value == 'cont':
-            values['type'] = 'float'
-        elif values['vtype'].value == 'cat':
-            values['type'] = 'str'
-        return values
+    # checks and casts the raw input in a single pass: verifies 'vtype', checks that 'min' and 'max' are included for
+    # types 'int', 'cont' and casts 'guess', 'min', 'max' to the data type of the variable, and checks that 'options' is
+    # included and 'guess' is a str for type 'cat'
+    @root_validator(pre=True)
+    def check_and_cast(cls, values):
+        try:
+            vtype = VarType(values.get('vtype'))
+        except ValueError:
+            raise ValueError("'vtype' must take value from set ['int', 'cont', 'cat']")
+        py_type, _ = _VTYPE_MAP[vtype]
+
+        if vtype is VarType.cat:
+            assert values.get('options') is not None, "'options' must be provided for 'vtype' cat"
+            g = values.get('guess')
+            assert isinstance(g, py_type), "data type mismatch between 'guess' and 'vtype'. Expected type 'str' " \
+                                           "from 'guess' but received " + str(type(g))
+        else:
+            assert values.get('min') is not None, "'min' must be provided for 'vtype' " + vtype.value
+            assert values.get('max') is not None, "'max' must be provided for 'vtype' " + vtype.value
+            if values.get('guess') is not None:
+                values['guess'] = py_type(values['guess'])
+            values['min'] = py_type(values['min'])
+            values['max'] = py_type(values['max'])
 
-    @root_validator(pre=True, allow_reuse=True)
-    def set_guessminmax_types(cls, values):
-        if values['vtype'] == 'int':
-            values['guess'] = int(values['guess'])
-            values['min'] = int(values['min'])
-            values['max'] = int(values['max'])
-        elif values['vtype'] == 'cont':
-            values['guess'] = float(values['guess'])
-            values['min'] = float(values['min'])
-            values['max'] = float(values['max'])
         return values
 
+    # add new field called "type" and remove all fields which have value None
+    @root_validator(pre=False, skip_on_failure=True)
+    def insert_type(cls, values):
+        values['type'] = _VTYPE_MAP[values['vtype']][1]
 
-    # check right data type of 'guess'
-    @validator('guess', allow_reuse=True)
-    def check_guess_datatype(cls, g, values):
-        if values['vtype'].value == 'int':
-            assert isinstance(g, int), "data type mismatch between 'guess' and 'vtype'. Expected type 'int' from 'guess' but received " + str(
-                type(g))
-            return g
-        elif values['vtype'].value == 'cont':
-            assert isinstance(g, float), "data type mismatch between 'guess' and 'vtype'. Expected type 'float' from 'guess' but received " + str(
-                type(g))
-            return g
-        elif values['vtype'].value == 'cat':
-            assert isinstance(g, str), "data type mismatch between 'guess' and 'vtype'. Expected type 'str' from 'guess' but received " + str(
-                type(g))
-            return g
-
-    # check that 'min' is included for types 'int', 'cont'
-    @validator('min', allow_reuse=True)
-    def check_min_included(cls, m, values):
-        if values['vtype'].value in ['int', 'cont']:
-            assert m is not None
-            return m
-
-    # check that 'max' is included for types 'int', 'cont'
-    @validator('max', allow_reuse=True)
-    def check_max_included(cls, m, values):
-        if values['vtype'].value in ['int', 'cont']:
-            assert m is not None
-            return m
-
-    # check that 'options' is included for type 'cat'
-    @validator('options', allow_reuse=True)
-    def check_options_included(cls, op, values):
-        if values['vtype'].value == 'cat':
-            assert op is not None
-            return op
-
-    # removes all fields which have value None
-    @root_validator(pre=False, allow_reuse=True)
-    def remove_all_nones(cls, values):
         values = {k: v for k, v in values.items() if v is not None}
         return values
 
@@ -116,10 +82,10 @@ class VariableOut(pydantic.BaseModel):
         return values
 
 
-# enums of TuneSession model types and acquisition function types
-tmp_cls = TuneSession(covars=[(0.5, 0.0, 1.0)])
-ModelTypes = Enum('ModelTypes', dict([(x,x) for x in tmp_cls.MODEL_LIST]))
-AcqFuncTypes = Enum('AcqFuncTypes', dict([(x,x) for x in tmp_cls.ACQ_FUNC_LIST]))
+# enums of TuneSession model types and acquisition function types. Built from the same helpers TuneSession uses to set
+# its MODEL_LIST and ACQ_FUNC_LIST attributes, so no TuneSession needs to be instantiated at import
+ModelTypes = Enum('ModelTypes', dict([(x,x) for x in _models_list()]))
+AcqFuncTypes = Enum('AcqFuncTypes', dict([(x,x) for x in AcqFunction().ACQ_FUNC_LIST]))
 
 
 # public class for creating an experiment via API
@@ -138,23 +104,39 @@ class Experiment(ormar.Model):
     '''
     class Meta(BaseMeta):
         tablename: str = "experiments"
+        # serves lookups of experiments by user as well as listing them ordered by time_updated
+        constraints = [ormar.IndexColumns("user", "time_updated")]
 
     id: int = ormar.Integer(primary_key=True, autoincrement=True)
     exp_uuid: str = ormar.UUID(uuid_format="string", default=uuid.uuid4, index=True)
     name: str = ormar.String(nullable=False, max_length=256)
     description: Optional[str] = ormar.Text(nullable=True)
     time_created: datetime = ormar.DateTime(default=datetime.utcnow, nullable=False)
-    time_updated: datetime = ormar.DateTime(default=datetime.utcnow, onupdate=datetime.utcnow, nullable=False)
+    time_updated: datetime = ormar.DateTime(default=datetime.utcnow, server_default=func.timezone("utc", func.now()),
+                                            onupdate=datetime.utcnow, nullable=False)  # explicitly set by app on update
     active: bool = ormar.Boolean(default=True, nullable=False)
-    covars: Json = ormar.JSON(nullable=False)
+    covars: Dict[str, Any] = ormar.JSON(nullable=False)
     model_type: str = ormar.String(max_length=100, choices=list(ModelTypes))
     acq_func_type: str = ormar.String(max_length=100, choices=list(AcqFuncTypes))
-    best_response: Json = ormar.JSON(nullable=True)  # best response from model
-    covars_best_response: Json = ormar.JSON(nullable=True)  # covariates corresponding to best response from model
+    best_response: Optional[Dict[str, Any]] = ormar.JSON(nullable=True)  # best response from model
+    covars_best_response: Optional[Dict[str, Any]] = ormar.JSON(nullable=True)  # covariates corresponding to best response from model
     covars_sampled_iter: int = ormar.Integer()
     response_sampled_iter: int = ormar.Integer()
     user: User = ormar.ForeignKey(User, nullable=False)
-    model_object_binary: str = ormar.LargeBinary(max_length=1000000, nullable=True) #ormar.Text(nullable=True)  # model file dumped to str
+
+
+class ExperimentModelObject(ormar.Model):
+    '''
+    ormar class (data model and database model) for the serialized TuneSession model object of an experiment. Kept in a
+    separate table so that queries on 'experiments' never read the (large) model object; it is only loaded when the
+    model object is needed and not already cached in the app
+    '''
+    class Meta(BaseMeta):
+        tablename: str = "experiment_model_objects"
+
+    id: int = ormar.Integer(primary_key=True, autoincrement=True)
+    experiment: Experiment = ormar.ForeignKey(Experiment, nullable=False, unique=True, related_name="model_objects")
+    model_object_binary: bytes = ormar.LargeBinary(max_length=1000000, nullable=False)  # model object dumped to bytes
 
 
 class PublicExperimentBase(pydantic.BaseModel):
@@ -170,8 +152,8 @@ class PublicExperimentBase(pydantic.BaseModel):
     time_created: datetime
     time_updated: datetime
     active: bool
-    best_response: Json
-    covars_best_response: Json
+    best_response: Optional[Dict[str, Any]]  # JSON columns are returned parsed from the db
+    covars_best_response: Optional[Dict[str, Any]]
     covars_sampled_iter: int
     response_sampled_iter: int
 
@@ -193,6 +175,13 @@ class PublicExperimentAsk(pydantic.BaseModel):
     covars_next_exp: str  # cannot make pydantic Json type accept .to_json()-output from pandas, so using str format
 
 
+# covariates or response reported to /experiment/tell/{exp_uuid}: single-row pandas dataframe in JSON form, either in
+# 'records' orientation (list of rows) or in 'columns' orientation (dict of columns). The JSON can be posted directly as
+# part of the request body, which is parsed once. For backwards compatibility a string with the output of pandas'
+# .to_json-method (JSON encoded inside the JSON body) is also accepted
+TellData = Union[List[Dict[str, Any]], Dict[str, Any], Json]
+
+
 class PublicExperimentTell(pydantic.BaseModel):
     '''
     data model for returning output from TuneSession '.tell'-method, in which user provides results to TuneSession
@@ -203,8 +192,8 @@ class PublicExperimentTell(pydantic.BaseModel):
     exp_uuid: UUID4
     covars_tell: str  # json of user-provided covariates (from pandas .to_json-method)
     response_tell: str  # json of user-provided response to those covariates (from pandas .to_json-method)
-    best_response: str  # json of historically best response (from pandas .to_json-method)
-    covars_best_reponse: str  # json of covariates of historically best response (from pandas .to_json-method)
+    best_response: Optional[str]  # json of historically best response (from pandas .to_json-method)
+    covars_best_reponse: Optional[str]  # json of covariates of historically best response (from pandas .to_json-method)
     covars_sampled_iter: int
     response_sampled_iter: int
     time_updated: datetime
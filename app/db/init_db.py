@@ -1,11 +1,47 @@
-from app.db.user import User
+import uuid
+from datetime import datetime
+import sqlalchemy
+from sqlalchemy.dialects.postgresql import insert
+from starlette.concurrency import run_in_threadpool
+
+from app.db import database, metadata, User  # app.db registers all tables on metadata
+from app.core.config import settings
 from app.core.security import get_password_hash
 
 
-# create first users
+# emails of users created at startup
+FIRST_USERS = ["test@test.com", "me@somewhere.com"]
+
+
+def create_schema():
+    """
+    create all tables which do not exist yet. Uses a short-lived sync engine, which is disposed afterwards
+    """
+
+    engine = sqlalchemy.create_engine(settings.db_url, pool_timeout=60)
+    try:
+        metadata.create_all(engine)
+    finally:
+        engine.dispose()
+
+
+# create schema (unless managed by migrations only) and first users
 async def init_db():
-    await User.objects.get_or_create(email="test@test.com", hashed_password=get_password_hash("CHANGEME"))
-    await User.objects.get_or_create(email="me@somewhere.com", hashed_password=get_password_hash("CHANGEME"))
+    if settings.create_schema:
+        await run_in_threadpool(create_schema)
+
+    # insert first users in a single statement, skipping those which exist already
+    users = [
+        {
+            "uuid": str(uuid.uuid4()),
+            "email": email,
+            "hashed_password": get_password_hash("CHANGEME"),
+            "time_created": datetime.utcnow(),
+            "active": True,
+        }
+        for email in FIRST_USERS
+    ]
+    await database.execute(insert(User.Meta.table).values(users).on_conflict_do_nothing(index_elements=["email"]))
 
 
 if __name__ == "__main__":
@@ -1,32 +1,73 @@
-import json
+import asyncio
+import weakref
 from datetime import datetime
 
+import orjson
 import pandas as pd
 from fastapi import HTTPException
-from fastapi.encoders import jsonable_encoder
+from ormar.exceptions import NoMatch
+from starlette.status import HTTP_409_CONFLICT
+from starlette.concurrency import run_in_threadpool
 from greattunes import TuneSession
-from greattunes.data_format_mappings import tensor2pretty_covariate
 
-from app.db import Experiment, User, PublicExperiment, PublicExperimentAsk, PublicExperimentTell
-from app.experimentops.utils import ParseModel, SetEncoder
+from app.db import database, Experiment, ExperimentModelObject, PublicExperiment, PublicExperimentAsk, \
+    PublicExperimentTell
+from app.experimentops.utils import ParseModel
+
+
+# mapping table (pandas uses different types than native python). Recast all to string type and compare strings.
+# Format: {pandas, python}
+_DTYPE_MAPPING_TABLE = {"object": str(str), "float64": str(float), "int64": str(int)}
+
+# column names and data types of reported responses
+_RESPONSE_COL_NAMES = frozenset(["Response"])
+_RESPONSE_COL_TYPES = {"Response": str(float)}
 
 
 # class for operations on experiments
 class ExperimentOperations:
 
+    # per-experiment locks. Requests for the same experiment handled by this process take turns on the model object, so
+    # that concurrent '.ask'/'.tell' calls do not overwrite each other's updates
+    _model_object_locks = weakref.WeakValueDictionary()
+
+    @staticmethod
+    def _model_object_lock(exp_uuid):
+        '''
+        get the lock guarding the model object of an experiment, creating it if no request currently holds it
+        :param exp_uuid (str): unique identifier for experiment
+        :return lock (asyncio.Lock)
+        '''
+
+        lock = ExperimentOperations._model_object_locks.get(str(exp_uuid))
+        if lock is None:
+            lock = asyncio.Lock()
+            ExperimentOperations._model_object_locks[str(exp_uuid)] = lock
+        return lock
+
     @staticmethod
     def create_experiment_model_object(covars, model, acq_func, **kwargs):
         cls = TuneSession(covars=covars, model=model, acq_func=acq_func)
         return cls
 
+    @staticmethod
+    def warm_up_model_object():
+        '''
+        instantiate a throwaway TuneSession so that the lazy imports and setup done by TuneSession (torch, BoTorch
+        models and acquisition functions) are paid for at startup rather than by the first request to /experiment/new
+        '''
+
+        ExperimentOperations.create_experiment_model_object(covars=[(0.5, 0.0, 1.0)], model="SingleTaskGP",
+                                                            acq_func="ExpectedImprovement")
+
     @staticmethod
     def parse_new_experiment(new_exp, user):
         '''
         parse input provided to /experiment/new endpoint
         :param new_exp (object of type PublicCreateExperiment):
         :param user (object of type User): user to which this experiment will be assigned
-        :return exp (object of type Experiment): can be saved to db via exp.save() operation
-        :return mdl (initialized TuneSession model object)
+        :return exp (object of type Experiment): can be saved to db via ExperimentOperations.save_new_experiment
+        :return mdl_binary (bytes): initialized TuneSession model object, serialized for storage in db
         '''
 
         # get dict
@@ -50,7 +91,7 @@ class ExperimentOperations:
         # create entry for db
         exp = Experiment(name=new_exp_dict["name"],
                          description=new_exp_dict["description"],
-                         covars=json.dumps(new_exp_dict["covars"], cls=SetEncoder),
+                         covars=ParseModel.covars_for_storage(new_exp_dict["covars"]),
                          model_type=new_exp_dict["model_type"].value,
                          acq_func_type=new_exp_dict["acq_func"].value,
                          covars_sampled_iter=covars_sampled_iter,
@@ -58,10 +99,76 @@ class ExperimentOperations:
                          best_response=best_response_json,
                          covars_best_response=covars_best_response_json,
                          user=user,  # user is foreign key to user table
-                         model_object_binary=ParseModel.dump_model_object_binary_to_string(mdl),
                          )
 
-        return exp
+        return exp, ParseModel.dump_model_object_binary_to_string(mdl)
+
+    @staticmethod
+    async def save_new_experiment(exp, mdl_binary):
+        '''
+        store new experiment and its serialized model object in db
+        :param exp (object of type Experiment): output from ExperimentOperations.parse_new_experiment
+        :param mdl_binary (bytes): output from ExperimentOperations.parse_new_experiment
+        '''
+
+        async with database.transaction():
+            await exp.save()
+            await ExperimentModelObject(experiment=exp, model_object_binary=mdl_binary).save()
+
+    @staticmethod
+    async def _load_model_object(exp):
+        '''
+        get the model object of an experiment. The model object is taken from the in-process cache if it is cached for
+        this version of the experiment, otherwise it is read from db and deserialized. Model objects are mutated by
+        '.ask' and '.tell', and must be handed back via ExperimentOperations._store_model_object
+        A missing model object (e.g. for experiments stored before model objects had their own table and the migrations
+        have not been run), or one that cannot be read back (invalid signature, unknown format) is reported as conflict.
+        Must be called while holding the lock of the experiment (ExperimentOperations._model_object_lock)
+        :param exp (Experiment entry): stored experiment, refreshed from db
+        :return model_object (instantiated TuneSession object)
+        '''
+
+        # 'exp' is read before the lock is taken, so a request which waited for the lock holds the experiment as it was
+        # before the previous request updated it. Refresh it, so its 'time_updated' matches the cached model object and
+        # its fields reflect that update
+        await exp.load()
+
+        model_object = ParseModel.model_cache.pop(exp.exp_uuid, exp.time_updated)
+        if model_object is None:
+            try:
+                stored = await ExperimentModelObject.objects.get(experiment=exp.id)
+            except NoMatch:
+                raise HTTPException(status_code=HTTP_409_CONFLICT, detail="Model object of experiment not found")
+
+            try:
+                model_object = await run_in_threadpool(ParseModel.load_model_object_binary_from_string,
+                                                       stored.model_object_binary)
+            except ValueError:
+                raise HTTPException(status_code=HTTP_409_CONFLICT, detail="Model object of experiment is invalid")
+
+        return model_object
+
+    @staticmethod
+    async def _store_model_object(exp, model_object, columns):
+        '''
+        write an updated model object to db together with updated fields of the experiment, and cache the model object
+        for the new version of the experiment. Sets 'time_updated' of the experiment
+        :param exp (Experiment entry): stored experiment, with updated values set for the fields in 'columns'
+        :param model_object (instantiated TuneSession object)
+        :param columns (list of str): fields of 'exp' to update in addition to 'time_updated'
+        '''
+
+        mdl_binary = await run_in_threadpool(ParseModel.dump_model_object_binary_to_string, model_object)
+        exp.time_updated = datetime.utcnow()
+
+        # a single UPDATE on each table, both filtered on own columns only (the foreign key and the primary key), so
+        # neither statement joins other tables
+        async with database.transaction():
+            await ExperimentModelObject.objects.filter(experiment=exp.id).update(model_object_binary=mdl_binary)
+            await exp.update(_columns=columns + ["time_updated"])  # updates fields in database
+
+        # no need to reload from the db (or to use RETURNING): exp.time_updated holds the timestamp just written
+        ParseModel.model_cache.put(exp.exp_uuid, exp.time_updated, model_object)
 
 
     @staticmethod
@@ -72,11 +179,8 @@ class ExperimentOperations:
         :return:
         '''
 
-        # identify the right experiment
-        exp = await Experiment.objects.get(Experiment.exp_uuid == exp_uuid)
-
-        # identify the associated user (a foreign key relation) via the primary key
-        user = await User.objects.get(User.id == exp.user.pk)
+        # identify the right experiment, loading the associated user (a foreign key relation) in the same query
+        exp = await Experiment.objects.select_related("user").get(Experiment.exp_uuid == exp_uuid)
 
         public_exp = PublicExperiment(
             exp_uuid=exp.exp_uuid,
@@ -86,13 +190,13 @@ class ExperimentOperations:
             time_updated=exp.time_updated,
             covars=exp.covars,
             model_type=exp.model_type,
-            acq_func_type=exp.acq_func_type,
+            acq_func=exp.acq_func_type,
             active=exp.active,
             best_response=exp.best_response,
             covars_best_response=exp.covars_best_response,
             covars_sampled_iter=exp.covars_sampled_iter,
             response_sampled_iter=exp.response_sampled_iter,
-            user_uuid=user.uuid
+            user_uuid=exp.user.uuid
         )
 
         return public_exp
@@ -107,21 +211,22 @@ class ExperimentOperations:
         :return:
         '''
 
-        # load model
-        model_object = ParseModel.load_model_object_binary_from_string(exp.model_object_binary)
+        async with ExperimentOperations._model_object_lock(exp.exp_uuid):
 
-        # find next datapoint, will be available as last entry in model_object.proposed_X (in torch double tensor
-        # format)
-        model_object.ask()
+            # load model, reusing the deserialized model object if it is cached for this version of the experiment
+            model_object = await ExperimentOperations._load_model_object(exp)
 
-        # display next datapoint as json
-        proposed_covars_json = ExperimentOperations._proposed_covars_json_for_API_return(model_object)
+            # find next datapoint, will be available as last entry in model_object.proposed_X (in torch double tensor
+            # format). This is CPU-bound (model fit and optimization of acquisition function) so is kept off the event
+            # loop
+            await run_in_threadpool(model_object.ask)
 
-        # update model binary in db
-        exp.model_object_binary = ParseModel.dump_model_object_binary_to_string(model_object)
-        exp.time_updated = datetime.utcnow()
-        await exp.update(_columns=["model_object_binary", "time_updated"])  # updates fields in database
-        await exp.load()  # loads the latest stored data (in order to get the timestamp)
+            # display next datapoint as json. This only maps a single row of values, which is cheaper than a hop to the
+            # threadpool
+            proposed_covars_json = ExperimentOperations._proposed_covars_json_for_API_return(model_object)
+
+            # update model binary in db
+            await ExperimentOperations._store_model_object(exp, model_object, columns=[])
 
         # define new exp data model class just for new covariates, cast data into that class and return it to the route
         # to be returned via API
@@ -142,34 +247,46 @@ class ExperimentOperations:
         :return json (json): proposed covariates for next experiment, returned in json format
         '''
 
-        # number of covariates
-        num_covars = model_object.proposed_X[-1].size()[0]
-
-        # convert to pandas
-        proposed_df = tensor2pretty_covariate(
-            train_X_sample=model_object.proposed_X[-1].reshape(1, num_covars),
-            covar_details=model_object.covar_details
-        )
-
-        return proposed_df.to_json(orient="records")
+        # proposed covariates in the tensor format used by TuneSession (one-hot encoding for categorical variables)
+        proposed_row = model_object.proposed_X[-1].tolist()
+
+        # map to user-facing format. Same mapping as greattunes' tensor2pretty_covariate, but done directly for the
+        # single proposed row instead of building a pandas dataframe
+        proposed_covars = {}
+        for name, details in model_object.covar_details.items():
+            if details["type"] == int:
+                proposed_covars[name] = int(round(proposed_row[details["columns"]]))
+            elif details["type"] == str:
+                # pick the category with the largest value across the one-hot encoded columns. Column names in
+                # "opt_names" are in format <variable_name>_<option_name>
+                colnums = details["columns"]
+                max_index = max(range(len(colnums)), key=lambda i: proposed_row[colnums[i]])
+                proposed_covars[name] = details["opt_names"][max_index][len(name) + 1:]
+            elif details["type"] == float:
+                proposed_covars[name] = proposed_row[details["columns"]]
+
+        return orjson.dumps([proposed_covars]).decode()
 
     @staticmethod
     def _process_json_to_pandas(input_json):
         '''
-        assumes input_json is as a pandas df converted to json string using .to_json() method. This method parses this
-        string and returns the pandas df, and raises an exception if this is not possible
-        :param input_json (json str of pandas df (one row))
+        assumes input_json is a pandas df converted to json (via .to_json() or .to_dict()) and already parsed by
+        FastAPI, either as a list of rows ('records' orientation) or as a dict of columns. This method builds the pandas
+        df directly from the parsed json, and raises an exception if this is not possible
+        :param input_json (parsed json of pandas df (one row))
         :return input_df (pandas df)
         '''
 
         try:
             # reads covars to pandas
-            #input_df = pd.read_json(input_json)
-            input_df = pd.DataFrame(jsonable_encoder(input_json))
+            if isinstance(input_json, list):
+                input_df = pd.DataFrame.from_records(input_json)
+            else:
+                input_df = pd.DataFrame(input_json)
 
             return input_df
 
-        except ValueError:
+        except (ValueError, TypeError):
             raise HTTPException(status_code=422, detail="Unprocessable entity: input json " + str(input_json))
 
     @staticmethod
@@ -192,28 +309,24 @@ class ExperimentOperations:
         # initialize
         verified = False
 
-        # mapping table (pandas uses different types than native python). Recast all to string type and compare strings.
-        # Format: {pandas, python}
-        mapping_table = {"object": str(str), "float64": str(float), "int64": str(int)}
-
-        # get column names and data types as list of tuples
+        # get column names and data types
         if content_type == "response":
-            col_types = {"Responses": str(float)}
+            col_types = _RESPONSE_COL_TYPES
         elif content_type == "covars":
             col_types = {k: str(v["type"]) for k, v in covar_details.items()}
 
-        # loop through columns
-        # for each column, grab the data type and convert to correct str using mapping table
-        # check that type is identical to what's in covars_details (str of that), using str compare
-        for ct in df.columns.to_list():
+        # convert the data types of all columns to str using the mapping table, and compare them in one go to what's in
+        # covars_details (str of that) for the columns in the experiment (as judged by column names). Data types not
+        # in the mapping table never match
+        received = df.dtypes.astype(str)
+        actual, expected = received.map(_DTYPE_MAPPING_TABLE).align(pd.Series(col_types, dtype=object), join="inner")
+        mismatched = actual.index[actual.values != expected.values]
 
-            # verify column name in the experiment by checking it exists in covar_details
-            if ct in list(col_types.keys()):
-
-                # verify data type
-                if not mapping_table[str(df[ct].dtype)] == col_types[ct]:
-                    raise TypeError("ExperimentOperations._verify_df_content_type: Expected data type " + col_types[ct]
-                                    + " but received " + mapping_table[str(df[ct].dtype)] + " for variable '" + ct + "'")
+        if len(mismatched) > 0:
+            raise TypeError("ExperimentOperations._verify_df_content_type: " + "; ".join(
+                "Expected data type " + expected[ct] + " but received "
+                + _DTYPE_MAPPING_TABLE.get(received[ct], received[ct]) + " for variable '" + ct + "'"
+                for ct in mismatched))
 
         verified = True
         return verified
@@ -237,20 +350,50 @@ class ExperimentOperations:
 
         # reference: columns to verify
         if content_type == "response":
-            col_names = ["Response"]
+            col_names = _RESPONSE_COL_NAMES
         elif content_type == "covars":
-            col_names = list(covar_details.keys())
+            col_names = covar_details.keys()
 
         # verify that all required column names are there
-        df_col_names = df.columns.to_list()
-        for cn in col_names:
-            if cn not in df_col_names:
-                verified = False
-                raise NameError("ExperimentOperations._verify_df_columns: Missing expected column " + cn + ", perhaps others.")
+        missing = col_names - set(df.columns)
+        if missing:
+            raise NameError("ExperimentOperations._verify_df_columns: Missing expected column(s) "
+                            + ", ".join(sorted(missing)))
 
         verified = True
         return verified
 
+    @staticmethod
+    def _tell_data_to_pandas(covars_tell, response_tell, covar_details):
+        '''
+        convert covariates and response reported to /experiment/tell/{exp_uuid} to pandas and verify their content
+        (column names and data types), otherwise raises HTTPExceptions
+        :param covars_tell (json): see ExperimentOperations.tell_datapoint
+        :param response_tell (json): see ExperimentOperations.tell_datapoint
+        :param covar_details (covar_details attribute from instantiated object of type TuneSession):
+        :return covars_df (pandas df)
+        :return response_df (pandas df)
+        '''
+
+        # convert to pandas
+        covars_df = ExperimentOperations._process_json_to_pandas(input_json=covars_tell)
+        response_df = ExperimentOperations._process_json_to_pandas(input_json=response_tell)
+
+        # check column names and data types of covars_tell and response_tell in a single pass, collecting all problems
+        # so they are reported together
+        errors = []
+        for stage, df, content_type in (("covariates", covars_df, "covars"), ("response", response_df, "response")):
+            for verify_df in (ExperimentOperations._verify_df_columns, ExperimentOperations._verify_df_content_type):
+                try:
+                    verify_df(df=df, covar_details=covar_details, content_type=content_type)
+                except (NameError, TypeError) as e:
+                    errors.append(stage + ": " + str(e))
+
+        if errors:
+            raise HTTPException(status_code=422, detail={"errors": errors})
+
+        return covars_df, response_df
+
     @staticmethod
     async def tell_datapoint(exp, covars_tell, response_tell):
         '''
@@ -271,66 +414,49 @@ class ExperimentOperations:
         :return tell_exp (instantiated data model object of type PublicExperimentTell)
         '''
 
-        # load model and retrieve covar_details
-        model_object = ParseModel.load_model_object_binary_from_string(exp.model_object_binary)
-        covar_details = model_object.covar_details
+        async with ExperimentOperations._model_object_lock(exp.exp_uuid):
 
-        # convert and check content of covars_tell
-        covars_df = ExperimentOperations._process_json_to_pandas(input_json=covars_tell)
-        try:
-            if not ExperimentOperations._verify_df_columns(df=covars_df, covar_details=covar_details,
-                                                           content_type="covars"):
-                raise ValueError("ExperimentOperations.tell_datapoint: Field names for covariates not accepted.")
-            if not ExperimentOperations._verify_df_content_type(df=covars_df, covar_details=covar_details,
-                                                                content_type="covars"):
-                raise TypeError("ExperimentOperations.tell_datapoint: Reported type for covariates not accepted.")
-        except (ValueError, NameError, TypeError):
-            raise HTTPException(status_code=422, detail="Unprocessable entity: covariates")
-
-        # convert and check content of response_tell
-        response_df = ExperimentOperations._process_json_to_pandas(input_json=response_tell)
-        try:
+            # load model (from cache if available) and retrieve covar_details
+            model_object = await ExperimentOperations._load_model_object(exp)
+            covar_details = model_object.covar_details
 
-            if not ExperimentOperations._verify_df_columns(df=response_df, covar_details=covar_details,
-                                                           content_type="response"):
-                raise ValueError("ExperimentOperations.tell_datapoint: Field name for response not accepted.")
-            if not ExperimentOperations._verify_df_content_type(df=response_df, covar_details=covar_details,
-                                                                content_type="response"):
-                raise TypeError("ExperimentOperations.tell_datapoint: Reported type for response not accepted.")
-        except (ValueError, NameError, TypeError):
-            raise HTTPException(status_code=422, detail="Unprocessable entity: response")
+            # convert and check content of covars_tell and response_tell. If rejected, the model object is unchanged and
+            # is handed back to the cache as it is, without dumping and storing it again
+            try:
+                covars_df, response_df = ExperimentOperations._tell_data_to_pandas(covars_tell, response_tell,
+                                                                                   covar_details)
+            except HTTPException:
+                ParseModel.model_cache.put(exp.exp_uuid, exp.time_updated, model_object)
+                raise
 
-        # report new data to model, save
-        model_object.tell(covar_obs=covars_df, response_obs=response_df)
+            # report new data to model, save. This is CPU-bound (model is retrained) so is kept off the event loop
+            await run_in_threadpool(model_object.tell, covar_obs=covars_df, response_obs=response_df)
 
-        # get best response
-        best_response_json, covars_best_response_json = ParseModel.dump_best_response_to_json(model_object)
+            # get best response
+            best_response_json, covars_best_response_json = ParseModel.dump_best_response_to_json(model_object)
 
-        # number of iterations taken in tuning
-        covars_sampled_iter, response_sampled_iter = ParseModel.dump_iteration_numbers(model_object)
-
-        # update 'exp' entry in 'experiments' db table
-        exp.model_object_binary = ParseModel.dump_model_object_binary_to_string(model_object)
-        exp.best_response = best_response_json
-        exp.covars_best_response = covars_best_response_json
-        exp.covars_sampled_iter = covars_sampled_iter
-        exp.response_sampled_iter = response_sampled_iter
-        exp.time_updated = datetime.utcnow()
+            # number of iterations taken in tuning
+            covars_sampled_iter, response_sampled_iter = ParseModel.dump_iteration_numbers(model_object)
 
-        await exp.update(_columns=["model_object_binary", "best_response", "covars_best_response",
-                                   "covars_sampled_iter", "response_sampled_iter", "time_updated"])  # updates fields in database
+            # update 'exp' entry in 'experiments' db table and the stored model object
+            exp.best_response = best_response_json
+            exp.covars_best_response = covars_best_response_json
+            exp.covars_sampled_iter = covars_sampled_iter
+            exp.response_sampled_iter = response_sampled_iter
 
-        # return output to user (new data model)
-        await exp.load()
+            await ExperimentOperations._store_model_object(exp, model_object,
+                                                           columns=["best_response", "covars_best_response",
+                                                                    "covars_sampled_iter", "response_sampled_iter"])
 
+        # return output to user (new data model). Built from the values just written, which are the same as stored in db
         tell_exp = PublicExperimentTell(
             exp_uuid=exp.exp_uuid,
-            covars_tell=str(covars_tell),
-            response_tell=str(response_tell),
-            best_response=str(exp.best_response),
-            covars_best_reponse=str(exp.covars_best_response),
-            covars_sampled_iter=exp.covars_sampled_iter,
-            response_sampled_iter=exp.response_sampled_iter,
+            covars_tell=orjson.dumps(covars_tell).decode(),
+            response_tell=orjson.dumps(response_tell).decode(),
+            best_response=best_response_json,
+            covars_best_reponse=covars_best_response_json,
+            covars_sampled_iter=covars_sampled_iter,
+            response_sampled_iter=response_sampled_iter,
             time_updated=exp.time_updated
         )
 
@@ -1,18 +1,252 @@
-import json
-import dill as dl
+import bisect
+import hashlib
+import hmac
+import io
+import pickle
+import struct
+import threading
+from collections import OrderedDict
+import cloudpickle
+import numpy as np
+import orjson
+import torch
+import zstandard as zstd
 
+from app.core.config import settings
 
-# custom json encoder for sets
-class SetEncoder(json.JSONEncoder):
-    def default(self, obj):
-       if isinstance(obj, set):
-          return list(obj)
-       return json.JSONEncoder.default(self, obj)
+
+# serializer for TuneSession objects. Model objects are pickled with the highest available protocol (protocol 5), which
+# lets objects supporting it (e.g. numpy arrays) hand over their data as out-of-band buffers rather than as opcodes in
+# the pickle stream
+class _ModelPickler(cloudpickle.CloudPickler):
+    '''
+    pickler for model objects which stores the data of CPU tensors as raw out-of-band buffers (via numpy arrays sharing
+    the tensor's memory), instead of letting torch write a separate serialized container for every tensor storage.
+
+    Tensors on the same storage (views and slices, e.g. training data referenced by several modules of a model) are
+    stored as views on shared data, so that data is written once and is shared again after loading. This takes two
+    passes: the first ('collect') only records the ranges of each storage spanned by tensors, the second writes the union
+    of these ranges once per storage and rebases every tensor onto it, regardless of the order tensors are pickled in
+    '''
+
+    def __init__(self, *args, storages, collect=False, **kwargs):
+        super().__init__(*args, **kwargs)
+        # per storage (by data pointer, size and dtype): [storage, spans, written]. The storage is kept alive so that its
+        # memory cannot be reused by another storage across both passes. 'spans' are the (start, end) element ranges
+        # of tensors, merged to disjoint ranges between the passes, and 'written' holds the array written for each
+        # merged range (by its start). Keeping the arrays alive lets the pickler memoize them, so each is written once
+        self._storages = storages
+        self._collect = collect
+
+    def reducer_override(self, obj):
+        if type(obj) is torch.Tensor and obj.device.type == "cpu" and not obj.requires_grad:
+            try:
+                return self._reduce_tensor(obj)
+            except (RuntimeError, TypeError, NotImplementedError):  # dtypes and tensor types not supported by numpy
+                pass
+        return super().reducer_override(obj)
+
+    def _reduce_tensor(self, obj):
+        size, stride = tuple(obj.size()), obj.stride()
+
+        # conjugate and negative views only set a bit on the tensor, their values are written as a copy of their own.
+        # Empty tensors have no data to share
+        if obj.is_conj() or obj.is_neg() or obj.numel() == 0:
+            if self._collect:
+                return tuple, ()
+            contiguous = obj.resolve_conj().resolve_neg().contiguous()
+            return _rebuild_tensor_view, (contiguous.view(-1).numpy(), 0, size, contiguous.stride())
+
+        # range of storage elements spanned by the tensor (strides of tensors are never negative). Tensors spanning
+        # much more of the storage than they hold (e.g. a column of a matrix) do not add their range, they only share
+        # data written for other tensors
+        start = obj.storage_offset()
+        end = start + sum((s - 1) * st for s, st in zip(size, stride)) + 1
+        dense = end - start <= 2 * obj.numel()
+
+        storage = obj.untyped_storage()
+        key = (storage.data_ptr(), storage.nbytes(), obj.dtype)
+
+        if self._collect:
+            entry = self._storages.setdefault(key, [storage, [], {}])
+            if dense:
+                entry[1].append((start, end))
+            return tuple, ()
+
+        # find the merged range containing the tensor
+        entry = self._storages.get(key)
+        if entry is not None:
+            _, ranges, written = entry
+            i = bisect.bisect_right(ranges, (start, float("inf"))) - 1
+            if i >= 0 and end <= ranges[i][1]:
+                range_start, range_end = ranges[i]
+                array = written.get(range_start)
+                if array is None:
+                    array = obj.new_empty(0).set_(storage, range_start, (range_end - range_start,), (1,)).numpy()
+                    written[range_start] = array
+                return _rebuild_tensor_view, (array, start - range_start, size, stride)
+
+        contiguous = obj.contiguous()
+        return _rebuild_tensor_view, (contiguous.view(-1).numpy(), 0, size, contiguous.stride())
+
+
+def _merge_ranges(ranges):
+    '''
+    merge (start, end) ranges into sorted, disjoint ranges covering the same elements
+    :param ranges (list of tuples of int)
+    :return merged (list of tuples of int)
+    '''
+
+    merged = []
+    for start, end in sorted(ranges):
+        if merged and start <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    return merged
+
+
+def _rebuild_tensor_view(base, offset, size, stride):
+    return torch.from_numpy(base).as_strided(size, stride, offset)
+
+
+class _NullFile:
+    def write(self, data):
+        return len(data)
+
+
+def _dumps(obj, buffer_callback):
+    # first pass: collect the ranges of tensor storages, nothing is kept of the pickle stream or of out-of-band buffers
+    storages = {}
+    _ModelPickler(_NullFile(), protocol=pickle.HIGHEST_PROTOCOL, buffer_callback=lambda buf: None, storages=storages,
+                  collect=True).dump(obj)
+    for entry in storages.values():
+        entry[1] = _merge_ranges(entry[1])
+
+    with io.BytesIO() as file:
+        _ModelPickler(file, protocol=pickle.HIGHEST_PROTOCOL, buffer_callback=buffer_callback,
+                      storages=storages).dump(obj)
+        return file.getvalue()
+
+
+# serialized model objects are stored in a signed envelope with layout
+# <format byte><HMAC-SHA256 signature><payload>
+# where the payload, compressed with zstd unless the format byte says otherwise, is
+# <number of buffers><length of each buffer><buffers><pickle stream>. The header and each buffer are padded to a
+# multiple of _ALIGNMENT bytes, so that the buffers are aligned for the arrays and tensors backed by them. The signature
+# covers the format byte and the stored payload. Blobs that fail signature verification are never decompressed or
+# unpickled
+_FORMAT_RAW = 0
+_FORMAT_ZSTD = 1
+_ZSTD_LEVEL = 3
+_SIGNATURE_LENGTH = hashlib.sha256().digest_size
+_COUNT_FORMAT = struct.Struct("<I")
+_LENGTH_FORMAT = struct.Struct("<Q")
+_ALIGNMENT = 64
+
+
+def _padding(size):
+    return bytes(-size % _ALIGNMENT)
+
+
+def _sign(*parts):
+    signer = hmac.new(settings.JWT_SECRET.encode(), digestmod=hashlib.sha256)
+    for part in parts:
+        signer.update(part)
+    return signer.digest()
+
+
+# mapping of the values for 'type' keyword in covars to data types
+_TYPE_MAP = {"str": str, "float": float, "int": int}
+
+# options for dumping pandas dataframes via orjson (index labels are integers)
+ORJSON_DF_OPTIONS = orjson.OPT_NON_STR_KEYS
+
+
+def _column_values(series):
+    '''
+    values of a pandas column as python objects. Datetime columns are converted to epoch milliseconds (NaT to None), as
+    written by to_json()
+    :param series (pandas series)
+    :return values (list)
+    '''
+
+    if getattr(series.dtype, "tz", None) is not None:
+        series = series.dt.tz_convert(None)
+    values = series.to_numpy()
+
+    if values.dtype.kind == "M":
+        millis = values.astype("datetime64[ms]")
+        return [None if nat else v for nat, v in zip(np.isnat(millis).tolist(), millis.astype(np.int64).tolist())]
+    return values.tolist()
+
+
+def _df_to_json(df):
+    '''
+    dump pandas df to JSON in the same format as df.reset_index(drop=True).to_json(), i.e. {column: {row number: value}}.
+    Values are converted column by column via numpy rather than cell by cell
+    :param df (pandas df)
+    :return df_json (str)
+    '''
+
+    row_numbers = range(len(df))
+    columns = {col: dict(zip(row_numbers, _column_values(df[col]))) for col in df.columns}
+    return orjson.dumps(columns, option=ORJSON_DF_OPTIONS).decode()
+
+
+# bounded in-process LRU cache of deserialized TuneSession objects
+class ModelCache:
+    '''
+    keeps deserialized model objects in memory so that repeated requests for the same experiment do not have to
+    unpickle the stored model object. Entries are keyed on the experiment uuid and are only valid for the 'time_updated'
+    value of the experiment they were stored under, so a model object is never served once the stored experiment has
+    moved on
+    '''
+
+    def __init__(self, maxsize=256):
+        self.maxsize = maxsize
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def pop(self, exp_uuid, time_updated):
+        '''
+        remove and return the cached model object for an experiment. Model objects are mutated by both '.ask' and
+        '.tell', so the entry is taken out of the cache while in use and must be put back via ModelCache.put. An entry
+        stored for a different 'time_updated' is left in place, as it may be newer than the experiment of the caller
+        :param exp_uuid (str): unique identifier for experiment
+        :param time_updated (datetime): 'time_updated' of the stored experiment
+        :return mdl (instantiated TuneSession object or None if not cached for this 'time_updated')
+        '''
+
+        with self._lock:
+            entry = self._entries.get(str(exp_uuid))
+            if entry is None or entry[0] != time_updated:
+                return None
+            del self._entries[str(exp_uuid)]
+
+        return entry[1]
+
+    def put(self, exp_uuid, time_updated, mdl):
+        '''
+        store model object for an experiment, replacing any entry stored for an earlier 'time_updated'
+        :param exp_uuid (str): unique identifier for experiment
+        :param time_updated (datetime): 'time_updated' of the stored experiment after the model object was saved
+        :param mdl (instantiated TuneSession object)
+        '''
+
+        with self._lock:
+            self._entries[str(exp_uuid)] = (time_updated, mdl)
+            self._entries.move_to_end(str(exp_uuid))
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
 
 
 # helper class for storing and reading
 class ParseModel:
 
+    # deserialized model objects shared across requests
+    model_cache = ModelCache(maxsize=256)
+
     # create method to parse covars to the original object required for TuneSession
     @staticmethod
     def _dict_replace_type_value(d):
@@ -23,18 +257,20 @@ class ParseModel:
         :return x (dict of covars with values for keyword "type" updated):
         '''
 
+        # walk nested dicts with an explicit stack of (source dict, output dict) pairs
         x = {}
-        for k, v in d.items():
-            if isinstance(v, dict):
-                v = ParseModel._dict_replace_type_value(v)
-            elif k == "type":
-                if v == "str":
-                    v = str
-                elif v == "float":
-                    v = float
-                elif v == "int":
-                    v = int
-            x[k] = v
+        stack = [(d, x)]
+        while stack:
+            src, dst = stack.pop()
+            for k, v in src.items():
+                # nested dicts first, so that a covariate named "type" is walked rather than looked up
+                if isinstance(v, dict):
+                    dst[k] = {}
+                    stack.append((v, dst[k]))
+                elif k == "type":
+                    dst[k] = _TYPE_MAP.get(v, v)
+                else:
+                    dst[k] = v
         return x
 
     @staticmethod
@@ -49,6 +285,22 @@ class ParseModel:
 
         return covars_out
 
+    @staticmethod
+    def covars_for_storage(covars):
+        '''
+        prepare covars in dict form (from posting to experiment/new endpoint) for storage in JSON column. Sets of
+        'options' for categorical variables are stored as sorted lists
+        :param covars (dict)
+        :return: covars_out (dict)
+        '''
+
+        covars_out = {
+            name: {k: sorted(v) if isinstance(v, set) else v for k, v in details.items()}
+            for name, details in covars.items()
+        }
+
+        return covars_out
+
     @staticmethod
     def dump_iteration_numbers(cls):
         '''
@@ -77,23 +329,47 @@ class ParseModel:
 
         best_response_json = None
         if cls.best_response is not None:
-            best_response_json = cls.best_response.reset_index(drop=True).to_json()
+            best_response_json = _df_to_json(cls.best_response)
 
         covars_best_response_json = None
         if cls.covars_best_response is not None:
-            covars_best_response_json = cls.covars_best_response.reset_index(drop=True).to_json()
+            covars_best_response_json = _df_to_json(cls.covars_best_response)
 
         return best_response_json, covars_best_response_json
 
     @staticmethod
     def dump_model_object_binary_to_string(mdl):
         '''
-        dump instantiated TuneSession model object to str format, e.g. for storage in db
+        dump instantiated TuneSession model object to str format, e.g. for storage in db. The model object is pickled
+        with protocol 5 (out-of-band buffers, including the data of tensors, are kept alongside the pickle stream),
+        compressed with zstd (if that makes it smaller) and the result is signed with HMAC so that tampered rows can be
+        rejected on load
         :param mdl (TuneSession object)
-        :return: mdl_str (str)
+        :return: mdl_str (bytes)
         '''
 
-        return dl.dumps(mdl)
+        buffers = []
+        data = _dumps(mdl, buffer_callback=buffers.append)
+        raw_buffers = [buf.raw() for buf in buffers]
+
+        header = _COUNT_FORMAT.pack(len(raw_buffers)) + b"".join(_LENGTH_FORMAT.pack(rb.nbytes) for rb in raw_buffers)
+        chunks = [header, _padding(len(header))]
+        for rb in raw_buffers:
+            chunks += [rb, _padding(rb.nbytes)]
+        chunks.append(data)
+        body_size = sum(len(chunk) for chunk in chunks)
+
+        # the buffers are fed to the compressor as they are, so they are not copied into an intermediate body first.
+        # Compressor objects are not safe for concurrent use, and this runs in the threadpool
+        compressor = zstd.ZstdCompressor(level=_ZSTD_LEVEL).compressobj(size=body_size)
+        fmt, payload = _FORMAT_ZSTD, b"".join([compressor.compress(chunk) for chunk in chunks] + [compressor.flush()])
+
+        # payloads which do not compress are stored as they are
+        if len(payload) >= body_size:
+            fmt, payload = _FORMAT_RAW, b"".join(chunks)
+
+        fmt_byte = bytes([fmt])
+        return b"".join([fmt_byte, _sign(fmt_byte, payload), payload])
 
     @staticmethod
     def load_model_object_binary_from_string(mdl_str):
@@ -103,4 +379,50 @@ class ParseModel:
         :return: mdl (instatiated TuneSession object)
         '''
 
-        return dl.loads(mdl_str)
+        mdl_view = memoryview(mdl_str)
+        if len(mdl_view) <= _SIGNATURE_LENGTH:
+            raise ValueError("ParseModel.load_model_object_binary_from_string: stored model object is truncated")
+
+        fmt_byte = bytes(mdl_view[:1])
+        signature = bytes(mdl_view[1:1 + _SIGNATURE_LENGTH])
+        payload = mdl_view[1 + _SIGNATURE_LENGTH:]
+
+        if fmt_byte[0] not in (_FORMAT_RAW, _FORMAT_ZSTD):
+            raise ValueError("ParseModel.load_model_object_binary_from_string: unsupported format " + str(fmt_byte[0])
+                             + " of stored model object")
+
+        # verify signature before anything is decompressed or unpickled
+        if not hmac.compare_digest(signature, _sign(fmt_byte, payload)):
+            raise ValueError("ParseModel.load_model_object_binary_from_string: signature verification failed for "
+                             "stored model object")
+
+        # decompressed (or copied) into a writable buffer, as tensors and arrays of the model object are backed by it
+        if fmt_byte[0] == _FORMAT_ZSTD:
+            body = memoryview(bytearray(zstd.frame_content_size(payload)))
+            with zstd.ZstdDecompressor().stream_reader(payload) as reader:
+                pos = 0
+                while pos < len(body):
+                    read = reader.readinto(body[pos:])
+                    if not read:
+                        raise ValueError("ParseModel.load_model_object_binary_from_string: stored model object is "
+                                         "truncated")
+                    pos += read
+        else:
+            body = memoryview(bytearray(payload))
+
+        # read out-of-band buffers, these are passed to the unpickler as zero-copy views
+        num_buffers, = _COUNT_FORMAT.unpack_from(body, 0)
+        offset = _COUNT_FORMAT.size
+        lengths = []
+        for _ in range(num_buffers):
+            length, = _LENGTH_FORMAT.unpack_from(body, offset)
+            lengths.append(length)
+            offset += _LENGTH_FORMAT.size
+        offset += len(_padding(offset))
+
+        buffers = []
+        for length in lengths:
+            buffers.append(body[offset:offset + length])
+            offset += length + len(_padding(length))
+
+        return pickle.loads(body[offset:], buffers=buffers)
@@ -1,8 +1,11 @@
-from fastapi import FastAPI
+from fastapi import FastAPI, HTTPException
+from fastapi.responses import ORJSONResponse
+from starlette.status import HTTP_503_SERVICE_UNAVAILABLE
 from app.api.routes import router as api_router
 from app.db import database, User
 from app.core.config import settings
 from app.db.init_db import init_db
+from app.experimentops.actions import ExperimentOperations
 
 
 tags_metadata = [
@@ -17,11 +20,20 @@ tags_metadata = [
     {
         "name": "Experiment",
         "description": "Creating and managing experiments.",
-    }
+    },
 ]
 
+# debug endpoints are only mounted when enabled in settings
+if settings.debug_endpoints:
+    tags_metadata.append({
+        "name": "Debug",
+        "description": "State of the connection pool to the database.",
+    })
+
 
-app = FastAPI(title=settings.project_name, version=settings.project_version, openapi_tags=tags_metadata)
+# responses are encoded with orjson rather than the stdlib json encoder
+app = FastAPI(title=settings.project_name, version=settings.project_version, openapi_tags=tags_metadata,
+              default_response_class=ORJSONResponse)
 app.include_router(api_router)
 
 
@@ -29,6 +41,25 @@ app.include_router(api_router)
 async def read_root():
     return await User.objects.all()
 
+
+@app.get("/ready")
+async def ready():
+    '''
+    readiness probe: the app is ready to serve requests once it is connected to the db and the db answers queries. Needs
+    no authentication, so it can be used by orchestrators
+    '''
+
+    if not database.is_connected:
+        raise HTTPException(status_code=HTTP_503_SERVICE_UNAVAILABLE, detail="Database not connected")
+
+    try:
+        await database.fetch_val("SELECT 1")
+    except Exception:
+        raise HTTPException(status_code=HTTP_503_SERVICE_UNAVAILABLE, detail="Database not available")
+
+    return {"database": "ok"}
+
+
 @app.on_event("startup")
 async def startup():
     if not database.is_connected:
@@ -36,6 +67,10 @@ async def startup():
 
     await init_db()
 
+    # pay for lazy imports of the modeling backend before serving requests, unless a fast start is preferred
+    if settings.warm_up_model:
+        ExperimentOperations.warm_up_model_object()
+
     #await User.objects.get_or_create(email="test@test.com", hashed_password=get_password_hash("CHANGEME"))
     #await User.objects.get_or_create(email="me@somewhere.com", hashed_password=get_password_hash("CHANGEME"))
 
@@ -0,0 +1,17 @@
+import orjson
+import pandas as pd
+import pytest
+
+pytest.importorskip("torch")
+from app.experimentops.utils import _df_to_json
+
+
+@pytest.mark.parametrize("df", [
+    pd.DataFrame({"x": [0.5, 1.25], "n": [1, 2], "c": pd.Series(["a", "b"], dtype=object)}),
+    pd.DataFrame({"Response": [3.0]}, index=[7]),
+    pd.DataFrame({"t": pd.to_datetime(["2022-01-01 12:00:00.123", None])}),
+    pd.DataFrame({"t": pd.to_datetime(["2022-01-01 12:00:00"]).tz_localize("Europe/Copenhagen")}),
+])
+@pytest.mark.filterwarnings("ignore:The default 'epoch' date format")
+def test_df_to_json_matches_pandas(df):
+    assert orjson.loads(_df_to_json(df)) == orjson.loads(df.reset_index(drop=True).to_json())
@@ -0,0 +1,71 @@
+import pytest
+
+# end-to-end tests of the experiment endpoints, these need the modeling backend and a running postgres
+pytest.importorskip("greattunes")
+from fastapi.testclient import TestClient
+
+
+NEW_EXPERIMENT = {
+    "name": "test experiment",
+    "description": "created by tests",
+    "covars": {
+        "x": {"vtype": "cont", "guess": 0.5, "min": 0, "max": 1},
+        "n": {"vtype": "int", "guess": 2, "min": 0, "max": 5},
+        "c": {"vtype": "cat", "guess": "a", "options": ["a", "b"]},
+    },
+}
+
+
+@pytest.fixture(scope="module")
+def client():
+    from app.main import app
+
+    client = TestClient(app)
+    try:
+        client.__enter__()  # runs startup: connects to db, creates schema and first users
+    except OSError:
+        pytest.skip("database not available")
+    yield client
+    client.__exit__(None, None, None)
+
+
+@pytest.fixture(scope="module")
+def auth_headers(client):
+    response = client.post("/auth/login", data={"username": "test@test.com", "password": "CHANGEME"})
+    assert response.status_code == 200
+    return {"Authorization": "Bearer " + response.json()["access_token"]}
+
+
+@pytest.fixture(scope="module")
+def new_experiment(client, auth_headers):
+    response = client.post("/experiment/new", json=NEW_EXPERIMENT, headers=auth_headers)
+    assert response.status_code == 201, response.text
+    return response.json()
+
+
+def test_create_experiment(new_experiment):
+    assert new_experiment["name"] == NEW_EXPERIMENT["name"]
+    assert new_experiment["time_updated"] is not None
+    assert new_experiment["covars"]["x"] == {"guess": 0.5, "min": 0.0, "max": 1.0, "type": "float"}
+    assert new_experiment["covars"]["c"]["type"] == "str"
+    assert new_experiment["covars_sampled_iter"] == 0
+    assert new_experiment["response_sampled_iter"] == 0
+
+
+def test_list_experiments_has_public_experiment_shape(client, auth_headers, new_experiment):
+    from app.db import PublicExperimentBase
+
+    response = client.get("/experiment/all", headers=auth_headers)
+    assert response.status_code == 200
+    listed = {exp["exp_uuid"]: exp for exp in response.json()}[new_experiment["exp_uuid"]]
+
+    # same fields and values as the experiment returned on creation, less the user
+    assert set(listed) == set(PublicExperimentBase.__fields__)
+    assert listed == {k: v for k, v in new_experiment.items() if k in PublicExperimentBase.__fields__}
+    assert isinstance(listed["covars"], dict)
+
+
+def test_ready_needs_no_authentication(client):
+    response = client.get("/ready")
+    assert response.status_code == 200
+    assert response.json() == {"database": "ok"}
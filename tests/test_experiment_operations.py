@@ -0,0 +1,19 @@
+import pandas as pd
+import pytest
+
+pytest.importorskip("greattunes")
+
+from app.experimentops.actions import ExperimentOperations
+
+
+def test_verify_df_content_type_rejects_non_numeric_response():
+    df = pd.DataFrame({"Response": ["high"]}, dtype=object)
+
+    with pytest.raises(TypeError, match="'Response'"):
+        ExperimentOperations._verify_df_content_type(df, covar_details={}, content_type="response")
+
+
+def test_verify_df_content_type_accepts_numeric_response():
+    df = pd.DataFrame({"Response": [1.5]})
+
+    assert ExperimentOperations._verify_df_content_type(df, covar_details={}, content_type="response")
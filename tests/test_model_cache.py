@@ -0,0 +1,36 @@
+from datetime import datetime, timedelta
+
+from app.experimentops.utils import ModelCache
+
+
+T0 = datetime(2022, 1, 1)
+T1 = T0 + timedelta(seconds=1)
+
+
+def test_pop_returns_entry_for_matching_time_updated():
+    cache = ModelCache()
+    model = object()
+    cache.put("exp", T1, model)
+
+    assert cache.pop("exp", T1) is model
+    assert cache.pop("exp", T1) is None
+
+
+def test_pop_keeps_entry_for_other_time_updated():
+    cache = ModelCache()
+    model = object()
+    cache.put("exp", T1, model)
+
+    # a request holding an outdated version of the experiment does not evict the current model object
+    assert cache.pop("exp", T0) is None
+    assert cache.pop("exp", T1) is model
+
+
+def test_put_evicts_least_recently_used():
+    cache = ModelCache(maxsize=2)
+    for name in ("a", "b", "c"):
+        cache.put(name, T0, name)
+
+    assert cache.pop("a", T0) is None
+    assert cache.pop("b", T0) == "b"
+    assert cache.pop("c", T0) == "c"
@@ -0,0 +1,112 @@
+import pickle
+import pytest
+
+torch = pytest.importorskip("torch")
+from app.experimentops.utils import ParseModel
+
+
+def roundtrip(obj):
+    return ParseModel.load_model_object_binary_from_string(ParseModel.dump_model_object_binary_to_string(obj))
+
+
+def test_roundtrip_tensors():
+    obj = {
+        "x": torch.rand(20, 3, dtype=torch.double),
+        "i": torch.arange(10),
+        "scalar": torch.tensor(1.5),
+        "empty": torch.empty(0, 4),
+        "transposed": torch.rand(4, 6).t(),
+    }
+
+    loaded = roundtrip(obj)
+
+    for name, tensor in obj.items():
+        assert loaded[name].dtype == tensor.dtype
+        assert torch.equal(loaded[name], tensor)
+
+
+def test_roundtrip_conj_and_neg_views():
+    z = torch.tensor([1 + 2j, 3 - 4j])
+    obj = {"conj": z.conj(), "neg": z.conj().imag}
+
+    loaded = roundtrip(obj)
+
+    assert torch.equal(loaded["conj"], obj["conj"])
+    assert torch.equal(loaded["neg"], obj["neg"])
+
+
+def test_loaded_tensors_are_aligned_and_writable():
+    loaded = roundtrip({"a": torch.rand(3), "b": torch.rand(5, dtype=torch.double), "c": torch.rand(7)})
+
+    for tensor in loaded.values():
+        assert tensor.data_ptr() % tensor.element_size() == 0
+        tensor.add_(1)
+
+
+def test_tampered_blob_is_rejected():
+    blob = bytearray(ParseModel.dump_model_object_binary_to_string({"a": torch.rand(3)}))
+    blob[-1] ^= 1
+
+    with pytest.raises(ValueError):
+        ParseModel.load_model_object_binary_from_string(bytes(blob))
+
+
+@pytest.mark.parametrize("blob", [b"", b"\x00", pickle.dumps({"a": 1})])
+def test_invalid_blob_is_rejected(blob):
+    with pytest.raises(ValueError):
+        ParseModel.load_model_object_binary_from_string(blob)
+
+
+def test_views_share_memory_after_loading():
+    x = torch.rand(10, 3)
+    loaded = roundtrip({"x": x, "head": x[:4], "row": x[2]})
+
+    assert torch.equal(loaded["head"], x[:4])
+    assert torch.equal(loaded["row"], x[2])
+    loaded["x"][2, 0] = -1.0
+    assert loaded["head"][2, 0] == -1.0
+    assert loaded["row"][0] == -1.0
+
+
+def test_small_slice_of_large_tensor_is_stored_alone():
+    large = torch.rand(1000, 200)
+    blob = ParseModel.dump_model_object_binary_to_string({"slice": large[5, :10], "column": large[:, 1]})
+
+    assert len(blob) < 4 * 1010 + 1024
+    loaded = ParseModel.load_model_object_binary_from_string(blob)
+    assert torch.equal(loaded["slice"], large[5, :10])
+    assert torch.equal(loaded["column"], large[:, 1])
+
+
+def test_distinct_storages_are_not_merged():
+    tensors = [torch.rand(n) for n in (0, 1, 5, 5)]
+    tensors += [torch.rand(3)[1:], torch.empty(0)]
+
+    loaded = roundtrip(tensors)
+
+    for original, restored in zip(tensors, loaded):
+        assert torch.equal(original, restored)
+
+
+def test_views_share_memory_when_pickled_before_base():
+    x = torch.rand(1000)
+    blob = ParseModel.dump_model_object_binary_to_string({"h": x[:500], "t": x[400:], "x": x})
+
+    loaded = ParseModel.load_model_object_binary_from_string(blob)
+    assert torch.equal(loaded["h"], x[:500])
+    assert torch.equal(loaded["t"], x[400:])
+    loaded["x"][450] = -1.0
+    assert loaded["h"][450] == -1.0
+    assert loaded["t"][50] == -1.0
+
+    # the data of x is written once
+    assert len(blob) < 4 * 1000 + 1024
+
+
+def test_strided_views_share_memory_with_base():
+    x = torch.rand(10, 3)
+    loaded = roundtrip({"column": x[:, 1], "x": x})
+
+    assert torch.equal(loaded["column"], x[:, 1])
+    loaded["x"][4, 1] = -1.0
+    assert loaded["column"][4] == -1.0
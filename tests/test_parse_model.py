@@ -0,0 +1,24 @@
+from app.experimentops.utils import ParseModel
+
+
+def test_parse_covars_dict_replaces_type_names():
+    covars = {
+        "x": {"type": "float", "guess": 0.5, "min": 0.0, "max": 1.0},
+        "n": {"type": "int", "guess": 2, "min": 0, "max": 5},
+        "c": {"type": "str", "guess": "a", "options": {"a", "b"}},
+    }
+
+    parsed = ParseModel.parse_covars_dict(covars)
+
+    assert parsed["x"]["type"] is float
+    assert parsed["n"]["type"] is int
+    assert parsed["c"]["type"] is str
+    assert parsed["c"]["options"] == {"a", "b"}
+
+
+def test_parse_covars_dict_covariate_named_type():
+    covars = {"type": {"type": "int", "guess": 1, "min": 0, "max": 2}}
+
+    parsed = ParseModel.parse_covars_dict(covars)
+
+    assert parsed == {"type": {"type": int, "guess": 1, "min": 0, "max": 2}}